@@ -0,0 +1,172 @@
+"""Admission control and load shedding per route class.
+
+Every route belongs to a class (cheap reads, writes, password hashing, heavy
+list/bulk calls, health checks). Each class has its own concurrency limit,
+a bounded wait queue with a queue-time budget and a per-client token bucket,
+so a pile-up of expensive calls is rejected early with 503/429 instead of
+starving the cheap endpoints that share the same workers.
+"""
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+HEALTH = 'health'
+READ = 'read'
+WRITE = 'write'
+AUTH = 'auth'
+HEAVY = 'heavy'
+
+# concurrency: handlers running at once; queue: callers allowed to wait for a slot;
+# queue_timeout: seconds a caller may wait; rate/burst: per-client token bucket (requests/second)
+DEFAULT_LIMITS = {
+    READ: {'concurrency': 32, 'queue': 64, 'queue_timeout': 2.0, 'rate': 20.0, 'burst': 60},
+    WRITE: {'concurrency': 16, 'queue': 32, 'queue_timeout': 2.0, 'rate': 10.0, 'burst': 30},
+    AUTH: {'concurrency': 4, 'queue': 8, 'queue_timeout': 2.0, 'rate': 0.5, 'burst': 5},
+    HEAVY: {'concurrency': 4, 'queue': 4, 'queue_timeout': 1.0, 'rate': 2.0, 'burst': 10},
+}
+
+ROUTE_CLASS_ATTR = 'route_class'
+
+ADMITTED = 'admitted'
+SHED = 'shed'
+RATE_LIMITED = 'rate-limited'
+
+
+def route_class(name):
+    """Decorator assigning a view to a route class; place it directly under @app.route"""
+    def decorator(f):
+        setattr(f, ROUTE_CLASS_ATTR, name)
+        return f
+    return decorator
+
+
+def parse_limits(overrides):
+    """DEFAULT_LIMITS updated with a JSON object such as '{"write": {"concurrency": 8}}'"""
+    limits = {name: dict(limit) for name, limit in DEFAULT_LIMITS.items()}
+    if not overrides:
+        return limits
+    for name, limit in json.loads(overrides).items():
+        if name not in limits:
+            raise ValueError(f'Unknown route class in admission limits: {name}')
+        unknown = set(limit) - set(limits[name])
+        if unknown:
+            raise ValueError(f'Unknown admission limit for {name}: {", ".join(sorted(unknown))}')
+        limits[name].update(limit)
+    return limits
+
+
+class _RouteClass(object):
+
+    def __init__(self, name, concurrency, queue, queue_timeout, rate, burst):
+        self.name = name
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.rate_limited = 0
+        self.queued = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def take_token(self, client_id, max_clients):
+        """Spend one token from the client's bucket; returns seconds until one is available"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(client_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self.buckets[client_id] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self.buckets[client_id] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            # Buckets of clients idle long enough to be full again carry no state worth keeping
+            while len(self.buckets) > max_clients:
+                self.buckets.popitem(last=False)
+            if wait:
+                self.rate_limited += 1
+        return wait
+
+
+class AdmissionController(object):
+    """Concurrency limits, queue budgets and rate limits for each route class"""
+
+    def __init__(self, limits=None, max_clients=10000):
+        self.max_clients = max_clients
+        self.classes = {}
+        for name, limit in (limits or DEFAULT_LIMITS).items():
+            self.classes[name] = _RouteClass(name, **limit)
+
+    def admit(self, name, client_id):
+        """Try to start a request; returns (outcome, retry_after_seconds)"""
+        route = self.classes.get(name)
+        if route is None:
+            return ADMITTED, 0
+
+        if route.rate:
+            wait = route.take_token(client_id, self.max_clients)
+            if wait:
+                return RATE_LIMITED, max(1, math.ceil(wait))
+
+        if route.semaphore.acquire(blocking=False):
+            with route.lock:
+                route.in_flight += 1
+                route.admitted += 1
+            return ADMITTED, 0
+
+        with route.lock:
+            if route.waiting >= route.queue:
+                route.shed += 1
+                return SHED, max(1, math.ceil(route.queue_timeout))
+            route.waiting += 1
+            route.queued += 1
+
+        started = time.monotonic()
+        acquired = route.semaphore.acquire(timeout=route.queue_timeout)
+        waited = time.monotonic() - started
+
+        with route.lock:
+            route.waiting -= 1
+            route.queue_time_total += waited
+            route.queue_time_max = max(route.queue_time_max, waited)
+            if not acquired:
+                route.shed += 1
+                return SHED, max(1, math.ceil(route.queue_timeout))
+            route.in_flight += 1
+            route.admitted += 1
+        return ADMITTED, 0
+
+    def release(self, name):
+        """Finish a request started with admit()"""
+        route = self.classes.get(name)
+        if route is None:
+            return
+        with route.lock:
+            route.in_flight -= 1
+        route.semaphore.release()
+
+    def metrics(self):
+        """Counters per route class"""
+        result = {}
+        for name, route in self.classes.items():
+            with route.lock:
+                result[name] = {
+                    'inFlight': route.in_flight,
+                    'waiting': route.waiting,
+                    'admitted': route.admitted,
+                    'queued': route.queued,
+                    'shed': route.shed,
+                    'rateLimited': route.rate_limited,
+                    'queueTimeTotalMs': round(route.queue_time_total * 1000, 1),
+                    'queueTimeMaxMs': round(route.queue_time_max * 1000, 1)
+                }
+        return result
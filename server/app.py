@@ -1,15 +1,35 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import os
 from datetime import datetime, timedelta
 import json
+from patient_index import PatientIndex, build_from_connection
+from scheduling import SlotIndex, SchedulingError, RELEASED_STATUSES, parse_date, to_minutes, to_time
+import idempotency
+import admission
+from admission import route_class
+import serialization
+import trends
+from history_cache import HistoryCache
 
 app = Flask(__name__)
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key-change-in-production')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=7)
+app.config['IDEMPOTENCY_MAX_ENTRIES'] = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 1000))
+app.config['IDEMPOTENCY_TTL_SECONDS'] = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600))
+app.config['IDEMPOTENCY_MAX_SPILLED'] = int(os.environ.get('IDEMPOTENCY_MAX_SPILLED', 100000))
+app.config['ADMISSION_CONTROL_ENABLED'] = os.environ.get('ADMISSION_CONTROL_ENABLED', '1') == '1'
+app.config['ADMISSION_LIMITS'] = admission.parse_limits(os.environ.get('ADMISSION_LIMITS'))
+
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['HISTORY_CACHE_ENABLED'] = os.environ.get('HISTORY_CACHE_ENABLED', '1') == '1'
+app.config['HISTORY_CACHE_MAX_BYTES'] = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+if serialization.orjson is not None:
+    app.json = serialization.ORJSONProvider(app)
 
 jwt = JWTManager(app)
 CORS(app)
@@ -17,6 +37,12 @@ CORS(app)
 # Database setup
 DATABASE = 'database.sqlite'
 
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to a table created by an older version of init_db"""
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
 def init_db():
     """Initialize the database with tables and sample data"""
     conn = sqlite3.connect(DATABASE)
@@ -71,12 +97,94 @@ def init_db():
             testDate TEXT,
             notes TEXT,
             status TEXT DEFAULT 'pending',
+            version INTEGER NOT NULL DEFAULT 0,
             createdAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            updatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updatedAt DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            FOREIGN KEY (userId) REFERENCES users (id),
+            FOREIGN KEY (testCatalogId) REFERENCES test_catalog (id)
+        )
+    ''')
+    add_column_if_missing(cursor, 'user_tests', 'version', 'INTEGER NOT NULL DEFAULT 0')
+    
+    # Result Series table - numeric user test results for trend charts
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS result_series (
+            userTestId INTEGER PRIMARY KEY,
+            userId INTEGER NOT NULL,
+            testCatalogId INTEGER NOT NULL,
+            testDate TEXT NOT NULL,
+            value REAL NOT NULL,
+            FOREIGN KEY (userTestId) REFERENCES user_tests (id),
             FOREIGN KEY (userId) REFERENCES users (id),
             FOREIGN KEY (testCatalogId) REFERENCES test_catalog (id)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_result_series_user_test_date ON result_series (userId, testCatalogId, testDate)')
+    trends.backfill(conn)
+    
+    # Personnel availability windows - bookable slots per personnel and date
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS personnel_availability (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnelId INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            startTime TEXT NOT NULL,
+            endTime TEXT NOT NULL,
+            slotMinutes INTEGER NOT NULL DEFAULT 15,
+            capacity INTEGER NOT NULL DEFAULT 1,
+            createdBy INTEGER,
+            createdAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (personnelId) REFERENCES users (id),
+            FOREIGN KEY (createdBy) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_availability_personnel_date ON personnel_availability (personnelId, date)')
+    
+    # Appointments table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patientId INTEGER NOT NULL,
+            personnelId INTEGER NOT NULL,
+            scheduledDate TEXT NOT NULL,
+            scheduledTime TEXT NOT NULL,
+            status TEXT DEFAULT 'scheduled',
+            totalAmount REAL NOT NULL DEFAULT 0,
+            notes TEXT,
+            createdBy INTEGER,
+            createdAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patientId) REFERENCES users (id),
+            FOREIGN KEY (personnelId) REFERENCES users (id),
+            FOREIGN KEY (createdBy) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_slot ON appointments (personnelId, scheduledDate, scheduledTime)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments (patientId, scheduledDate)')
+    
+    # Appointment Tests table - user_tests rows ordered with an appointment
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointment_tests (
+            appointmentId INTEGER NOT NULL,
+            userTestId INTEGER NOT NULL,
+            PRIMARY KEY (appointmentId, userTestId),
+            FOREIGN KEY (appointmentId) REFERENCES appointments (id),
+            FOREIGN KEY (userTestId) REFERENCES user_tests (id)
+        )
+    ''')
+    
+    # Idempotency keys table - responses spilled from the in-memory idempotency store
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB,
+            expiresAt REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expiresAt)')
     
     # Create admin user
     admin_password = generate_password_hash('admin123')
@@ -120,6 +228,52 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+# Responses of POST/PUT/DELETE requests sent with an Idempotency-Key header
+idempotency_store = idempotency.IdempotencyStore(
+    get_db_connection,
+    max_entries=app.config['IDEMPOTENCY_MAX_ENTRIES'],
+    ttl_seconds=app.config['IDEMPOTENCY_TTL_SECONDS'],
+    max_spilled=app.config['IDEMPOTENCY_MAX_SPILLED']
+)
+
+# Concurrency, queue-time and rate limits per route class
+admission_controller = admission.AdmissionController(app.config['ADMISSION_LIMITS'])
+
+# Serialized GET /api/user-tests responses per patient; invalidated by every user_tests write
+history_cache = HistoryCache(
+    max_bytes=app.config['HISTORY_CACHE_MAX_BYTES'],
+    enabled=app.config['HISTORY_CACHE_ENABLED']
+)
+
+# Fuzzy duplicate-patient index, kept in sync by register_patient and update_user
+patient_index = PatientIndex()
+
+def get_patient_index():
+    """Get the duplicate-patient index, building it from the database on first use"""
+    if not patient_index.is_built:
+        conn = get_db_connection()
+        build_from_connection(conn, patient_index)
+        conn.close()
+    return patient_index
+
+# Appointment slot index, kept in sync by the appointment routes
+slot_index = SlotIndex()
+
+def get_slot_index():
+    """Get the appointment slot index, loading upcoming windows and bookings on first use"""
+    if not slot_index.is_loaded:
+        today = datetime.now().strftime('%Y-%m-%d')
+        conn = get_db_connection()
+        windows = conn.execute('SELECT * FROM personnel_availability WHERE date >= ?', (today,)).fetchall()
+        placeholders = ', '.join('?' * len(RELEASED_STATUSES))
+        bookings = conn.execute(
+            f'SELECT personnelId, scheduledDate, scheduledTime FROM appointments WHERE scheduledDate >= ? AND status NOT IN ({placeholders})',
+            (today,) + RELEASED_STATUSES
+        ).fetchall()
+        conn.close()
+        slot_index.load(windows, bookings)
+    return slot_index
+
 def generate_user_number(role):
     """Generate unique user number based on role"""
     conn = get_db_connection()
@@ -162,8 +316,139 @@ def require_role(roles):
         return decorated_function
     return decorator
 
+def json_body_response(body, status=200):
+    """Wrap JSON bytes produced by the serialization module in a response"""
+    return app.response_class(body, status=status, mimetype='application/json')
+
+@app.after_request
+def compress_response(response):
+    """Gzip or deflate JSON responses when the client accepts it"""
+    if (response.mimetype != 'application/json' or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.status_code < 200):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = serialization.choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    
+    response.set_data(serialization.compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def get_optional_identity():
+    """JWT identity of the caller, or None when the request has no valid token"""
+    try:
+        verify_jwt_in_request(optional=True)
+        return get_jwt_identity()
+    except Exception:
+        return None
+
+def get_client_id():
+    """Identify the caller for rate limiting: the JWT user if present, else the remote address"""
+    user_id = get_optional_identity()
+    if user_id is not None:
+        return f'user:{user_id}'
+    return f'ip:{request.remote_addr}'
+
+@app.before_request
+def check_idempotency_key():
+    """Replay or coalesce retried mutating requests that carry an Idempotency-Key.
+    
+    Registered before admit_request, so replays and retries waiting on the
+    original request do not hold an admission slot.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if not key or request.method not in ('POST', 'PUT', 'DELETE'):
+        return None
+    
+    if len(key) > 255:
+        return jsonify({'message': 'Idempotency-Key must be at most 255 characters'}), 400
+    
+    # Only authenticated callers claim a key; the route itself rejects everyone else
+    if get_optional_identity() is None:
+        return None
+    
+    scoped_key = idempotency.scope_key(key, request.headers.get('Authorization'), request.method, request.path)
+    request_fingerprint = idempotency.fingerprint(request.get_data())
+    status, stored = idempotency_store.begin(scoped_key, request_fingerprint)
+    
+    if status == idempotency.MISMATCH:
+        return jsonify({'message': 'Idempotency-Key was already used with a different request'}), 422
+    if status == idempotency.IN_PROGRESS:
+        return jsonify({'message': 'A request with this Idempotency-Key is still in progress'}), 409
+    if status == idempotency.REPLAY:
+        response = app.response_class(stored.body, status=stored.status, headers=stored.headers)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    
+    g.idempotency_key = (scoped_key, request_fingerprint)
+    return None
+
+@app.after_request
+def store_idempotent_response(response):
+    """Keep the first response for an Idempotency-Key; server and auth errors stay retryable"""
+    claimed = g.pop('idempotency_key', None)
+    if claimed:
+        scoped_key, request_fingerprint = claimed
+        if response.status_code < 500 and response.status_code not in (401, 403) and not response.is_streamed:
+            idempotency_store.complete(scoped_key, request_fingerprint, response.status_code,
+                                       list(response.headers.items()), response.get_data())
+        else:
+            idempotency_store.abandon(scoped_key)
+    return response
+
+@app.teardown_request
+def release_idempotency_key(exc):
+    """Release a claimed key if the request failed before a response was stored"""
+    claimed = g.pop('idempotency_key', None)
+    if claimed:
+        idempotency_store.abandon(claimed[0])
+
+@app.before_request
+def admit_request():
+    """Shed or rate limit requests before they reach a worker-heavy handler"""
+    if not app.config['ADMISSION_CONTROL_ENABLED'] or request.method == 'OPTIONS':
+        return None
+    
+    view = app.view_functions.get(request.endpoint)
+    if view is None:
+        return None
+    
+    name = getattr(view, admission.ROUTE_CLASS_ATTR, None)
+    if name is None:
+        name = admission.READ if request.method in ('GET', 'HEAD') else admission.WRITE
+    if name == admission.HEALTH:
+        return None
+    
+    outcome, retry_after = admission_controller.admit(name, get_client_id())
+    if outcome != admission.ADMITTED:
+        # The handler never ran, so a retry with the same Idempotency-Key must run it
+        claimed = g.pop('idempotency_key', None)
+        if claimed:
+            idempotency_store.abandon(claimed[0])
+    if outcome == admission.RATE_LIMITED:
+        return jsonify({'message': 'Too many requests, please retry later'}), 429, {'Retry-After': str(retry_after)}
+    if outcome == admission.SHED:
+        return jsonify({'message': 'Server is busy, please retry later'}), 503, {'Retry-After': str(retry_after)}
+    
+    g.admission_class = name
+    return None
+
+@app.teardown_request
+def release_admission(exc):
+    """Free the route class slot taken by admit_request"""
+    name = g.pop('admission_class', None)
+    if name:
+        admission_controller.release(name)
+
 # Authentication routes
 @app.route('/api/auth/login', methods=['POST'])
+@route_class(admission.AUTH)
 def login():
     try:
         data = request.get_json()
@@ -207,6 +492,7 @@ def login():
         return jsonify({'message': 'Server error during login'}), 500
 
 @app.route('/api/auth/register-personnel', methods=['POST'])
+@route_class(admission.AUTH)
 @jwt_required()
 @require_role(['admin'])
 def register_personnel():
@@ -291,10 +577,13 @@ def register_patient():
             conn.close()
             return jsonify({'message': 'User already exists with this phone number'}), 400
         
+        # Look for likely duplicates registered under another phone or a misspelled name
+        possible_duplicates = get_patient_index().search(data['firstName'], data['lastName'], data['dateOfBirth'])
+        
         # Generate user number for patient
         user_number = generate_user_number('patient')
         
-        # Create new patient (email is optional)
+        # Create new patient (email is optional; patients have no password, stored as '' for the NOT NULL column)
         address = json.dumps(data.get('address', {})) if data.get('address') else None
         email = data.get('email') if data.get('email') else None
         
@@ -302,7 +591,7 @@ def register_patient():
             INSERT INTO users (userNumber, firstName, lastName, email, password, phone, dateOfBirth, gender, address, role, createdBy)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
-            user_number, data['firstName'], data['lastName'], email, None, data['phone'],
+            user_number, data['firstName'], data['lastName'], email, '', data['phone'],
             data['dateOfBirth'], data['gender'], address, 'patient', get_jwt_identity()
         ))
         
@@ -310,6 +599,11 @@ def register_patient():
         conn.commit()
         conn.close()
         
+        patient_index.add({
+            'id': user_id, 'userNumber': user_number, 'firstName': data['firstName'],
+            'lastName': data['lastName'], 'phone': data['phone'], 'dateOfBirth': data['dateOfBirth']
+        })
+        
         return jsonify({
             'message': 'Patient registered successfully',
             'user': {
@@ -320,7 +614,8 @@ def register_patient():
                 'email': email,
                 'phone': data['phone'],
                 'role': 'patient'
-            }
+            },
+            'possibleDuplicates': possible_duplicates
         }), 201
         
     except Exception as e:
@@ -332,26 +627,16 @@ def register_patient():
 def get_current_user():
     try:
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE id = ?', (get_jwt_identity(),)).fetchone()
+        body = serialization.query_row_json(conn, 'user', '''
+            SELECT id, userNumber, firstName, lastName, email, phone, dateOfBirth, gender, address, role
+            FROM users WHERE id = ?
+        ''', (get_jwt_identity(),), json_columns=('address',))
         conn.close()
         
-        if not user:
+        if body is None:
             return jsonify({'message': 'User not found'}), 404
         
-        user_data = {
-            'id': user['id'],
-            'userNumber': user['userNumber'],
-            'firstName': user['firstName'],
-            'lastName': user['lastName'],
-            'email': user['email'],
-            'phone': user['phone'],
-            'dateOfBirth': user['dateOfBirth'],
-            'gender': user['gender'],
-            'address': json.loads(user['address']) if user['address'] else None,
-            'role': user['role']
-        }
-        
-        return jsonify({'user': user_data})
+        return json_body_response(body)
         
     except Exception as e:
         return jsonify({'message': 'Server error'}), 500
@@ -365,14 +650,13 @@ def get_test_catalog():
         category = request.args.get('category')
         
         if category:
-            tests = conn.execute('SELECT * FROM test_catalog WHERE category = ? AND isActive = 1 ORDER BY name', (category,)).fetchall()
+            body = serialization.query_rows_json(conn, 'tests', 'SELECT * FROM test_catalog WHERE category = ? AND isActive = 1 ORDER BY name', (category,))
         else:
-            tests = conn.execute('SELECT * FROM test_catalog WHERE isActive = 1 ORDER BY category, name').fetchall()
+            body = serialization.query_rows_json(conn, 'tests', 'SELECT * FROM test_catalog WHERE isActive = 1 ORDER BY category, name')
         
         conn.close()
         
-        tests_list = [dict(test) for test in tests]
-        return jsonify({'tests': tests_list})
+        return json_body_response(body)
         
     except Exception as e:
         return jsonify({'message': 'Server error'}), 500
@@ -425,34 +709,65 @@ def create_test_catalog():
         return jsonify({'message': 'Server error creating test catalog'}), 500
 
 # User Tests routes
+USER_TEST_UPDATE_FIELDS = ['testResult', 'testDate', 'notes', 'status']
+MAX_BULK_UPDATES = 500
+# Body of GET /api/user-tests for a patient without tests (same for both encoders)
+EMPTY_TEST_HISTORY = b'{"tests":[]}'
+# user_tests.updatedAt keeps milliseconds so expectedUpdatedAt tells apart writes within one second
+USER_TEST_UPDATED_AT = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+def check_user_test_version(test, update):
+    """Return a conflict entry if the row changed since the client read it, else None"""
+    expected_version = update.get('expectedVersion')
+    expected_updated_at = update.get('expectedUpdatedAt')
+    if expected_version is not None and expected_version != test['version']:
+        reason = 'version'
+    elif expected_updated_at is not None and expected_updated_at != test['updatedAt']:
+        reason = 'updatedAt'
+    else:
+        return None
+    return {
+        'id': test['id'],
+        'message': f'Test was modified by another user ({reason} mismatch)',
+        'currentVersion': test['version'],
+        'currentUpdatedAt': test['updatedAt']
+    }
+
 @app.route('/api/user-tests', methods=['GET'])
 @jwt_required()
 def get_user_tests():
     try:
-        conn = get_db_connection()
-        user_id = request.args.get('userId')
+        user_id = request.args.get('userId', type=int)
         
         if not user_id:
             return jsonify({'message': 'userId parameter is required'}), 400
         
-        # Check if user can access these tests
-        current_user = conn.execute('SELECT role FROM users WHERE id = ?', (get_jwt_identity(),)).fetchone()
-        if current_user['role'] == 'patient' and int(user_id) != get_jwt_identity():
+        # Check if user can access these tests; anyone may read their own
+        if user_id != get_jwt_identity():
+            conn = get_db_connection()
+            current_user = conn.execute('SELECT role FROM users WHERE id = ?', (get_jwt_identity(),)).fetchone()
             conn.close()
-            return jsonify({'message': 'Insufficient permissions'}), 403
-        
-        tests = conn.execute('''
-            SELECT ut.*, tc.name as testName, tc.category, tc.description, tc.normalRange, tc.price
-            FROM user_tests ut
-            LEFT JOIN test_catalog tc ON ut.testCatalogId = tc.id
-            WHERE ut.userId = ? 
-            ORDER BY ut.createdAt DESC
-        ''', (user_id,)).fetchall()
+            if current_user['role'] == 'patient':
+                return jsonify({'message': 'Insufficient permissions'}), 403
         
-        conn.close()
+        body = history_cache.get(user_id)
+        if body is None:
+            token = history_cache.begin_read(user_id)
+            conn = get_db_connection()
+            body = serialization.query_rows_json(conn, 'tests', '''
+                SELECT ut.*, tc.name as testName, tc.category, tc.description, tc.normalRange, tc.price
+                FROM user_tests ut
+                LEFT JOIN test_catalog tc ON ut.testCatalogId = tc.id
+                WHERE ut.userId = ? 
+                ORDER BY ut.createdAt DESC
+            ''', (user_id,))
+            conn.close()
+            # Empty histories are cheap to query and would let a caller walking
+            # unknown user ids fill the cache
+            if body != EMPTY_TEST_HISTORY:
+                history_cache.put(user_id, body, token)
         
-        tests_list = [dict(test) for test in tests]
-        return jsonify({'tests': tests_list})
+        return json_body_response(body)
         
     except Exception as e:
         return jsonify({'message': 'Server error'}), 500
@@ -484,18 +799,22 @@ def create_user_test():
             conn.close()
             return jsonify({'message': 'Test not found in catalog'}), 404
         
-        cursor = conn.execute('''
-            INSERT INTO user_tests (userId, testCatalogId, testResult, testDate, notes, status)
-            VALUES (?, ?, ?, ?, ?, ?)
+        cursor = conn.execute(f'''
+            INSERT INTO user_tests (userId, testCatalogId, testResult, testDate, notes, status, updatedAt)
+            VALUES (?, ?, ?, ?, ?, ?, {USER_TEST_UPDATED_AT})
         ''', (
             data['userId'], data['testCatalogId'], data.get('testResult'),
             data.get('testDate'), data.get('notes'), data.get('status', 'pending')
         ))
         
         test_id = cursor.lastrowid
+        if data.get('testResult') is not None:
+            trends.record_results(conn, [test_id])
         conn.commit()
         conn.close()
         
+        history_cache.invalidate(user['id'])
+        
         return jsonify({
             'message': 'Test created successfully',
             'test': {
@@ -512,6 +831,50 @@ def create_user_test():
     except Exception as e:
         return jsonify({'message': 'Server error creating test'}), 500
 
+@app.route('/api/users/<int:user_id>/trends', methods=['GET'])
+@jwt_required()
+def get_user_trends(user_id):
+    try:
+        conn = get_db_connection()
+        
+        # Check if user can access these results
+        current_user = conn.execute('SELECT role FROM users WHERE id = ?', (get_jwt_identity(),)).fetchone()
+        if current_user['role'] == 'patient' and user_id != get_jwt_identity():
+            conn.close()
+            return jsonify({'message': 'Insufficient permissions'}), 403
+        
+        max_points = min(max(request.args.get('points', 200, type=int), 3), 2000)
+        
+        query = '''
+            SELECT rs.testCatalogId, tc.name, tc.normalRange, rs.testDate, rs.value
+            FROM result_series rs
+            LEFT JOIN test_catalog tc ON rs.testCatalogId = tc.id
+            WHERE rs.userId = ?
+        '''
+        params = [user_id]
+        
+        if request.args.get('testCatalogId'):
+            query += ' AND rs.testCatalogId = ?'
+            params.append(request.args.get('testCatalogId'))
+        
+        if request.args.get('from'):
+            query += ' AND rs.testDate >= ?'
+            params.append(request.args.get('from'))
+        
+        if request.args.get('to'):
+            query += ' AND rs.testDate <= ?'
+            params.append(request.args.get('to'))
+        
+        query += ' ORDER BY rs.testCatalogId, rs.testDate'
+        
+        rows = conn.execute(query, params).fetchall()
+        conn.close()
+        
+        return jsonify({'trends': trends.build_trends(rows, max_points)})
+        
+    except Exception as e:
+        return jsonify({'message': 'Server error'}), 500
+
 @app.route('/api/user-tests/<int:test_id>', methods=['PUT'])
 @jwt_required()
 @require_role(['personnel', 'admin'])
@@ -526,12 +889,17 @@ def update_user_test(test_id):
             conn.close()
             return jsonify({'message': 'Test not found'}), 404
         
+        # Optional optimistic concurrency check (expectedVersion or expectedUpdatedAt)
+        conflict = check_user_test_version(test, data)
+        if conflict:
+            conn.close()
+            return jsonify(conflict), 409
+        
         # Build dynamic update query
         fields = []
         values = []
         
-        allowed_fields = ['testResult', 'testDate', 'notes', 'status']
-        for field in allowed_fields:
+        for field in USER_TEST_UPDATE_FIELDS:
             if field in data:
                 fields.append(f'{field} = ?')
                 values.append(data[field])
@@ -540,18 +908,130 @@ def update_user_test(test_id):
             conn.close()
             return jsonify({'message': 'No valid fields to update'}), 400
         
-        values.append(test_id)
-        query = f'UPDATE user_tests SET {", ".join(fields)}, updatedAt = CURRENT_TIMESTAMP WHERE id = ?'
+        values.extend([test_id, test['version']])
+        query = f'UPDATE user_tests SET {", ".join(fields)}, updatedAt = {USER_TEST_UPDATED_AT}, version = version + 1 WHERE id = ? AND version = ?'
         
-        conn.execute(query, values)
+        cursor = conn.execute(query, values)
+        if cursor.rowcount == 0:
+            # Another request updated the row between our SELECT and UPDATE
+            conn.rollback()
+            conn.close()
+            return jsonify({'id': test_id, 'message': 'Test was modified by another user, reload and retry'}), 409
+        
+        if 'testResult' in data or 'testDate' in data:
+            trends.record_results(conn, [test_id])
+        
+        updated = conn.execute('SELECT updatedAt, version FROM user_tests WHERE id = ?', (test_id,)).fetchone()
         conn.commit()
         conn.close()
         
-        return jsonify({'message': 'Test updated successfully'})
+        history_cache.invalidate(test['userId'])
+        
+        return jsonify({'message': 'Test updated successfully', 'updatedAt': updated['updatedAt'], 'version': updated['version']})
         
     except Exception as e:
         return jsonify({'message': 'Server error updating test'}), 500
 
+@app.route('/api/user-tests/bulk', methods=['PUT'])
+@route_class(admission.HEAVY)
+@jwt_required()
+@require_role(['personnel', 'admin'])
+def bulk_update_user_tests():
+    try:
+        data = request.get_json()
+        updates = data.get('updates') if isinstance(data, dict) else None
+        
+        # Validation
+        if not isinstance(updates, list) or not updates:
+            return jsonify({'message': 'updates must be a non-empty list'}), 400
+        
+        if len(updates) > MAX_BULK_UPDATES:
+            return jsonify({'message': f'At most {MAX_BULK_UPDATES} updates per request'}), 400
+        
+        ids = []
+        for update in updates:
+            if not isinstance(update, dict) or not isinstance(update.get('id'), int):
+                return jsonify({'message': 'Each update needs an integer id'}), 400
+            fields = update.get('fields')
+            if not isinstance(fields, dict) or not fields:
+                return jsonify({'message': f'Update {update["id"]} has no fields'}), 400
+            invalid = [field for field in fields if field not in USER_TEST_UPDATE_FIELDS]
+            if invalid:
+                return jsonify({'message': f'Invalid fields for update {update["id"]}: {", ".join(invalid)}'}), 400
+            if update.get('expectedVersion') is None and update.get('expectedUpdatedAt') is None:
+                return jsonify({'message': f'Update {update["id"]} needs expectedVersion or expectedUpdatedAt'}), 400
+            ids.append(update['id'])
+        
+        if len(set(ids)) != len(ids):
+            return jsonify({'message': 'Each test may appear only once per request'}), 400
+        
+        conn = get_db_connection()
+        try:
+            # Hold the write lock so the version checks and updates are atomic
+            conn.execute('BEGIN IMMEDIATE')
+            
+            placeholders = ', '.join('?' * len(ids))
+            current = {
+                test['id']: test
+                for test in conn.execute(f'SELECT id, userId, updatedAt, version FROM user_tests WHERE id IN ({placeholders})', ids)
+            }
+            
+            conflicts = []
+            not_found = []
+            # Updates touching the same set of fields share one executemany statement
+            batches = {}
+            for update in updates:
+                test = current.get(update['id'])
+                if test is None:
+                    not_found.append(update['id'])
+                    continue
+                conflict = check_user_test_version(test, update)
+                if conflict:
+                    conflicts.append(conflict)
+                    continue
+                fields = tuple(field for field in USER_TEST_UPDATE_FIELDS if field in update['fields'])
+                values = [update['fields'][field] for field in fields]
+                batches.setdefault(fields, []).append(values + [test['id'], test['version']])
+            
+            for fields, rows in batches.items():
+                assignments = ', '.join(f'{field} = ?' for field in fields)
+                conn.executemany(
+                    f'UPDATE user_tests SET {assignments}, updatedAt = {USER_TEST_UPDATED_AT}, version = version + 1 WHERE id = ? AND version = ?',
+                    rows
+                )
+            
+            updated_ids = [row[-2] for rows in batches.values() for row in rows]
+            trends.record_results(conn, [
+                row[-2]
+                for fields, rows in batches.items() if 'testResult' in fields or 'testDate' in fields
+                for row in rows
+            ])
+            updated = []
+            if updated_ids:
+                placeholders = ', '.join('?' * len(updated_ids))
+                updated = [
+                    dict(test) for test in
+                    conn.execute(f'SELECT id, updatedAt, version FROM user_tests WHERE id IN ({placeholders}) ORDER BY id', updated_ids)
+                ]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        history_cache.invalidate(*{current[test['id']]['userId'] for test in updated})
+        
+        return jsonify({
+            'message': f'{len(updated)} tests updated',
+            'updated': updated,
+            'conflicts': conflicts,
+            'notFound': not_found
+        })
+        
+    except Exception as e:
+        return jsonify({'message': 'Server error updating tests'}), 500
+
 @app.route('/api/user-tests/<int:test_id>', methods=['DELETE'])
 @jwt_required()
 @require_role(['personnel', 'admin'])
@@ -559,12 +1039,17 @@ def delete_user_test(test_id):
     try:
         conn = get_db_connection()
         
-        cursor = conn.execute('DELETE FROM user_tests WHERE id = ?', (test_id,))
+        test = conn.execute('SELECT userId FROM user_tests WHERE id = ?', (test_id,)).fetchone()
+        if not test:
+            conn.close()
+            return jsonify({'message': 'Test not found'}), 404
+        
+        conn.execute('DELETE FROM user_tests WHERE id = ?', (test_id,))
+        trends.remove_results(conn, [test_id])
         conn.commit()
         conn.close()
         
-        if cursor.rowcount == 0:
-            return jsonify({'message': 'Test not found'}), 404
+        history_cache.invalidate(test['userId'])
         
         return jsonify({'message': 'Test deleted successfully'})
         
@@ -573,6 +1058,7 @@ def delete_user_test(test_id):
 
 # Users routes
 @app.route('/api/users', methods=['GET'])
+@route_class(admission.HEAVY)
 @jwt_required()
 def get_users():
     try:
@@ -595,11 +1081,51 @@ def get_users():
         
         query += ' ORDER BY lastName, firstName'
         
-        users = conn.execute(query, params).fetchall()
+        body = serialization.query_rows_json(conn, 'users', query, params)
+        conn.close()
+        
+        return json_body_response(body)
+        
+    except Exception as e:
+        return jsonify({'message': 'Server error'}), 500
+
+@app.route('/api/users/duplicates', methods=['GET'])
+@jwt_required()
+@require_role(['personnel', 'admin'])
+def find_duplicate_patients():
+    try:
+        first_name = request.args.get('firstName')
+        last_name = request.args.get('lastName')
+        date_of_birth = request.args.get('dateOfBirth')
+        
+        if not first_name or not last_name:
+            return jsonify({'message': 'firstName and lastName parameters are required'}), 400
+        
+        limit = min(int(request.args.get('limit', 10)), 50)
+        exclude_id = request.args.get('excludeId', type=int)
+        
+        candidates = get_patient_index().search(first_name, last_name, date_of_birth, limit=limit, exclude_id=exclude_id)
+        return jsonify({'candidates': candidates})
+        
+    except ValueError:
+        return jsonify({'message': 'Invalid limit'}), 400
+    except Exception as e:
+        return jsonify({'message': 'Server error'}), 500
+
+@app.route('/api/users/duplicate-clusters', methods=['GET'])
+@route_class(admission.HEAVY)
+@jwt_required()
+@require_role(['admin'])
+def get_duplicate_clusters():
+    try:
+        # Scan a private index built from the table, so the scan also covers rows
+        # changed outside this process and never blocks the shared index
+        conn = get_db_connection()
+        index = build_from_connection(conn)
         conn.close()
         
-        users_list = [dict(user) for user in users]
-        return jsonify({'users': users_list})
+        clusters = index.clusters()
+        return jsonify({'clusters': clusters, 'patientsScanned': len(index)})
         
     except Exception as e:
         return jsonify({'message': 'Server error'}), 500
@@ -609,17 +1135,17 @@ def get_users():
 def get_user(user_id):
     try:
         conn = get_db_connection()
-        user = conn.execute('SELECT id, userNumber, firstName, lastName, email, phone, dateOfBirth, gender, address, role, isActive, createdAt FROM users WHERE id = ?', (user_id,)).fetchone()
+        body = serialization.query_row_json(
+            conn, 'user',
+            'SELECT id, userNumber, firstName, lastName, email, phone, dateOfBirth, gender, address, role, isActive, createdAt FROM users WHERE id = ?',
+            (user_id,), json_columns=('address',)
+        )
         conn.close()
         
-        if not user:
+        if body is None:
             return jsonify({'message': 'User not found'}), 404
         
-        user_data = dict(user)
-        if user_data['address']:
-            user_data['address'] = json.loads(user_data['address'])
-        
-        return jsonify({'user': user_data})
+        return json_body_response(body)
         
     except Exception as e:
         return jsonify({'message': 'Server error'}), 500
@@ -657,24 +1183,329 @@ def update_user(user_id):
         
         conn.execute(query, values)
         conn.commit()
+        
+        updated_user = conn.execute('SELECT id, userNumber, firstName, lastName, phone, dateOfBirth, role, isActive FROM users WHERE id = ?', (user_id,)).fetchone()
         conn.close()
         
+        if patient_index.is_built:
+            patient_index.refresh(updated_user)
+        
         return jsonify({'message': 'User updated successfully'})
         
     except Exception as e:
         return jsonify({'message': 'Server error updating user'}), 500
 
+# Appointment routes
+@app.route('/api/appointments/windows', methods=['POST'])
+@jwt_required()
+@require_role(['personnel', 'admin'])
+def create_availability_window():
+    try:
+        data = request.get_json()
+        
+        # Validation
+        required_fields = ['personnelId', 'date', 'startTime', 'endTime']
+        for field in required_fields:
+            if not data.get(field):
+                return jsonify({'message': f'{field} is required'}), 400
+        
+        try:
+            personnel_id = int(data['personnelId'])
+            slot_minutes = int(data.get('slotMinutes', 15))
+            capacity = int(data.get('capacity', 1))
+            parse_date(data['date'])
+            # Store times as HH:MM so "8:00" and "08:00" are the same slot
+            start_time = to_time(to_minutes(data['startTime']))
+            end_time = to_time(to_minutes(data['endTime']))
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Invalid personnelId, date, time, slotMinutes or capacity'}), 400
+        
+        if capacity < 1:
+            return jsonify({'message': 'capacity must be at least 1'}), 400
+        
+        conn = get_db_connection()
+        
+        personnel = conn.execute('SELECT id FROM users WHERE id = ? AND role IN ("personnel", "admin") AND isActive = 1', (personnel_id,)).fetchone()
+        if not personnel:
+            conn.close()
+            return jsonify({'message': 'Personnel not found'}), 404
+        
+        def store_window():
+            cursor = conn.execute('''
+                INSERT INTO personnel_availability (personnelId, date, startTime, endTime, slotMinutes, capacity, createdBy)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (personnel_id, data['date'], start_time, end_time, slot_minutes, capacity, get_jwt_identity()))
+            conn.commit()
+            return cursor.lastrowid
+        
+        try:
+            window_id = get_slot_index().add_window(
+                personnel_id, data['date'], start_time, end_time, slot_minutes, capacity, store_window
+            )
+        except SchedulingError as e:
+            return jsonify({'message': str(e)}), 409
+        finally:
+            conn.close()
+        
+        return jsonify({
+            'message': 'Availability window created successfully',
+            'window': {
+                'id': window_id,
+                'personnelId': personnel_id,
+                'date': data['date'],
+                'startTime': start_time,
+                'endTime': end_time,
+                'slotMinutes': slot_minutes,
+                'capacity': capacity
+            }
+        }), 201
+        
+    except SchedulingError as e:
+        return jsonify({'message': str(e)}), 409
+    except Exception as e:
+        return jsonify({'message': 'Server error creating availability window'}), 500
+
+@app.route('/api/appointments/availability', methods=['GET'])
+@jwt_required()
+def get_availability():
+    try:
+        date = request.args.get('date')
+        if not date:
+            return jsonify({'message': 'date parameter is required'}), 400
+        
+        try:
+            parse_date(date)
+        except ValueError:
+            return jsonify({'message': 'Invalid date'}), 400
+        
+        personnel_id = request.args.get('personnelId', type=int)
+        slots = get_slot_index().free_slots(date, personnel_id)
+        return jsonify({'slots': slots})
+        
+    except Exception as e:
+        return jsonify({'message': 'Server error'}), 500
+
+@app.route('/api/appointments', methods=['GET'])
+@jwt_required()
+def get_appointments():
+    try:
+        conn = get_db_connection()
+        
+        query = 'SELECT * FROM appointments WHERE 1=1'
+        params = []
+        
+        # Patients only ever see their own appointments
+        current_user = conn.execute('SELECT role FROM users WHERE id = ?', (get_jwt_identity(),)).fetchone()
+        if current_user['role'] == 'patient':
+            query += ' AND patientId = ?'
+            params.append(get_jwt_identity())
+        elif request.args.get('patientId'):
+            query += ' AND patientId = ?'
+            params.append(request.args.get('patientId'))
+        
+        for field, column in (('personnelId', 'personnelId'), ('date', 'scheduledDate'), ('status', 'status')):
+            if request.args.get(field):
+                query += f' AND {column} = ?'
+                params.append(request.args.get(field))
+        
+        query += ' ORDER BY scheduledDate, scheduledTime'
+        
+        body = serialization.query_rows_json(conn, 'appointments', query, params)
+        conn.close()
+        
+        return json_body_response(body)
+        
+    except Exception as e:
+        return jsonify({'message': 'Server error'}), 500
+
+@app.route('/api/appointments', methods=['POST'])
+@jwt_required()
+@require_role(['personnel', 'admin'])
+def create_appointment():
+    try:
+        data = request.get_json()
+        
+        # Validation
+        required_fields = ['patientId', 'personnelId', 'scheduledDate', 'scheduledTime']
+        for field in required_fields:
+            if not data.get(field):
+                return jsonify({'message': f'{field} is required'}), 400
+        
+        try:
+            personnel_id = int(data['personnelId'])
+            parse_date(data['scheduledDate'])
+            scheduled_time = to_time(to_minutes(data['scheduledTime']))
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Invalid personnelId, scheduledDate or scheduledTime'}), 400
+        
+        if data['scheduledDate'] < datetime.now().strftime('%Y-%m-%d'):
+            return jsonify({'message': 'Cannot book an appointment in the past'}), 400
+        
+        test_ids = data.get('tests', [])
+        if not isinstance(test_ids, list):
+            return jsonify({'message': 'tests must be a list of test catalog ids'}), 400
+        
+        # Claim the slot in memory first so concurrent bookings fail fast
+        index = get_slot_index()
+        try:
+            capacity = index.reserve(personnel_id, data['scheduledDate'], scheduled_time)
+        except SchedulingError as e:
+            return jsonify({'message': str(e)}), 409
+        
+        conn = get_db_connection()
+        try:
+            # Take the write lock up front so the capacity check and inserts are atomic
+            conn.execute('BEGIN IMMEDIATE')
+            
+            patient = conn.execute('SELECT id FROM users WHERE id = ? AND role = "patient"', (data['patientId'],)).fetchone()
+            if not patient:
+                raise LookupError('Patient not found')
+            
+            tests = []
+            for test_catalog_id in test_ids:
+                test = conn.execute('SELECT id, price FROM test_catalog WHERE id = ? AND isActive = 1', (test_catalog_id,)).fetchone()
+                if not test:
+                    raise LookupError('Test not found in catalog')
+                tests.append(test)
+            
+            # Re-check against the table in case another process booked the slot
+            placeholders = ', '.join('?' * len(RELEASED_STATUSES))
+            booked = conn.execute(f'''
+                SELECT COUNT(*) FROM appointments
+                WHERE personnelId = ? AND scheduledDate = ? AND scheduledTime = ? AND status NOT IN ({placeholders})
+            ''', (personnel_id, data['scheduledDate'], scheduled_time) + RELEASED_STATUSES).fetchone()[0]
+            if booked >= capacity:
+                raise SchedulingError('Slot is fully booked')
+            
+            total_amount = sum(test['price'] for test in tests)
+            cursor = conn.execute('''
+                INSERT INTO appointments (patientId, personnelId, scheduledDate, scheduledTime, status, totalAmount, notes, createdBy)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                data['patientId'], personnel_id, data['scheduledDate'], scheduled_time,
+                'scheduled', total_amount, data.get('notes'), get_jwt_identity()
+            ))
+            appointment_id = cursor.lastrowid
+            
+            user_test_ids = []
+            for test in tests:
+                cursor = conn.execute(f'''
+                    INSERT INTO user_tests (userId, testCatalogId, testDate, status, updatedAt)
+                    VALUES (?, ?, ?, ?, {USER_TEST_UPDATED_AT})
+                ''', (data['patientId'], test['id'], data['scheduledDate'], 'pending'))
+                user_test_ids.append(cursor.lastrowid)
+            
+            conn.executemany(
+                'INSERT INTO appointment_tests (appointmentId, userTestId) VALUES (?, ?)',
+                [(appointment_id, user_test_id) for user_test_id in user_test_ids]
+            )
+            conn.commit()
+        except (LookupError, SchedulingError) as e:
+            conn.rollback()
+            index.release(personnel_id, data['scheduledDate'], scheduled_time)
+            status_code = 409 if isinstance(e, SchedulingError) else 404
+            return jsonify({'message': str(e)}), status_code
+        except Exception:
+            conn.rollback()
+            index.release(personnel_id, data['scheduledDate'], scheduled_time)
+            raise
+        finally:
+            conn.close()
+        
+        if user_test_ids:
+            history_cache.invalidate(patient['id'])
+        
+        return jsonify({
+            'message': 'Appointment booked successfully',
+            'appointment': {
+                'id': appointment_id,
+                'patientId': data['patientId'],
+                'personnelId': personnel_id,
+                'scheduledDate': data['scheduledDate'],
+                'scheduledTime': scheduled_time,
+                'status': 'scheduled',
+                'totalAmount': total_amount,
+                'notes': data.get('notes'),
+                'userTestIds': user_test_ids
+            }
+        }), 201
+        
+    except Exception as e:
+        return jsonify({'message': 'Server error booking appointment'}), 500
+
+@app.route('/api/appointments/<int:appointment_id>', methods=['PUT'])
+@jwt_required()
+@require_role(['personnel', 'admin'])
+def update_appointment(appointment_id):
+    try:
+        data = request.get_json()
+        
+        if 'status' in data and data['status'] not in ['scheduled', 'in-progress', 'completed', 'cancelled']:
+            return jsonify({'message': 'Invalid status'}), 400
+        
+        conn = get_db_connection()
+        
+        appointment = conn.execute('SELECT * FROM appointments WHERE id = ?', (appointment_id,)).fetchone()
+        if not appointment:
+            conn.close()
+            return jsonify({'message': 'Appointment not found'}), 404
+        
+        # Build dynamic update query
+        fields = []
+        values = []
+        
+        allowed_fields = ['status', 'notes']
+        for field in allowed_fields:
+            if field in data:
+                fields.append(f'{field} = ?')
+                values.append(data[field])
+        
+        if not fields:
+            conn.close()
+            return jsonify({'message': 'No valid fields to update'}), 400
+        
+        was_released = appointment['status'] in RELEASED_STATUSES
+        if was_released and data.get('status', appointment['status']) not in RELEASED_STATUSES:
+            conn.close()
+            return jsonify({'message': 'Cancelled appointments cannot be reopened; book a new appointment instead'}), 409
+        
+        values.append(appointment_id)
+        query = f'UPDATE appointments SET {", ".join(fields)}, updatedAt = CURRENT_TIMESTAMP WHERE id = ?'
+        
+        conn.execute(query, values)
+        conn.commit()
+        conn.close()
+        
+        if not was_released and data.get('status') in RELEASED_STATUSES:
+            get_slot_index().release(appointment['personnelId'], appointment['scheduledDate'], appointment['scheduledTime'])
+        
+        return jsonify({'message': 'Appointment updated successfully'})
+        
+    except Exception as e:
+        return jsonify({'message': 'Server error updating appointment'}), 500
+
 
 @app.route('/')
+@route_class(admission.HEALTH)
 def home():
     return jsonify({'message': 'Lab Management API is running!', 'version': '1.0.0'})
 
 @app.route('/api/health')
+@route_class(admission.HEALTH)
 def health():
     return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
 
+@app.route('/api/metrics')
+@route_class(admission.HEALTH)
+@jwt_required()
+@require_role(['admin'])
+def metrics():
+    return jsonify({'admission': admission_controller.metrics(), 'historyCache': history_cache.metrics()})
+
 if __name__ == '__main__':
     init_db()
+    get_patient_index()
+    get_slot_index()
     print("Starting Lab Management API server...")
     print("Database initialized successfully!")
     print("Server will be available at: http://localhost:8000")
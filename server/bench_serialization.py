@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Benchmark JSON serialization of the list endpoints.
+
+Compares the previous path (sqlite3.Row -> dict -> jsonify with Flask's
+default JSON provider, even when app.py has switched to orjson) with the
+precompiled row encoders for the users and user-tests list queries and
+prints the throughput of each in bytes of JSON per second.
+
+    python bench_serialization.py [--users 5000] [--tests-per-user 20]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from flask.json.provider import DefaultJSONProvider
+
+import app as lab_app
+import serialization
+
+USERS_QUERY = 'SELECT id, userNumber, firstName, lastName, email, phone, dateOfBirth, gender, role, isActive, createdAt FROM users WHERE 1=1 ORDER BY lastName, firstName'
+USER_TESTS_QUERY = '''
+    SELECT ut.*, tc.name as testName, tc.category, tc.description, tc.normalRange, tc.price
+    FROM user_tests ut
+    LEFT JOIN test_catalog tc ON ut.testCatalogId = tc.id
+    ORDER BY ut.createdAt DESC
+'''
+
+
+def populate(conn, users, tests_per_user):
+    """Fill the database with synthetic patients and test results"""
+    first_names = ['Mehmet', 'Ayşe', 'Fatma', 'Ali', 'Zeynep', 'Mustafa', 'Emine', 'Hüseyin']
+    last_names = ['Yılmaz', 'Kaya', 'Demir', 'Şahin', 'Çelik', 'Öztürk', 'Aydın', 'Arslan']
+    conn.executemany('''
+        INSERT INTO users (userNumber, firstName, lastName, email, password, phone, dateOfBirth, gender, role)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'patient')
+    ''', [
+        (f'PAT{i:06d}', random.choice(first_names), random.choice(last_names), f'patient{i}@example.com',
+         '-', f'555-{i:07d}', f'19{random.randint(40, 99)}-0{random.randint(1, 9)}-1{random.randint(0, 9)}',
+         random.choice(['male', 'female']))
+        for i in range(1, users + 1)
+    ])
+    conn.executemany('''
+        INSERT INTO user_tests (userId, testCatalogId, testResult, testDate, notes, status)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [
+        (user_id, random.randint(1, 10), f'{random.uniform(1, 200):.1f} mg/dL', '2024-05-01', 'Routine check', 'completed')
+        for user_id in range(3, users + 3)
+        for _ in range(tests_per_user)
+    ])
+    conn.commit()
+
+
+def bench(label, fn, repeat):
+    size = len(fn())
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f'{label:<36} {size / 1e6:8.2f} MB {elapsed * 1000:9.1f} ms {size / elapsed / 1e6:9.1f} MB/s')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--tests-per-user', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        lab_app.DATABASE = os.path.join(tmp, 'bench.sqlite')
+        lab_app.init_db()
+        conn = lab_app.get_db_connection()
+        populate(conn, args.users, args.tests_per_user)
+        backend = 'orjson' if serialization.orjson is not None else 'json'
+        print(f'{args.users} users, {args.users * args.tests_per_user} user tests, row encoder backend: {backend}')
+
+        # The previous path: jsonify before app.py installed ORJSONProvider
+        baseline = DefaultJSONProvider(lab_app.app)
+        with lab_app.app.app_context():
+            for endpoint, key, query in (('GET /api/users', 'users', USERS_QUERY),
+                                         ('GET /api/user-tests', 'tests', USER_TESTS_QUERY)):
+                before = bench(f'{endpoint} jsonify', lambda: baseline.response(
+                    {key: [dict(row) for row in conn.execute(query).fetchall()]}).get_data(), args.repeat)
+                after = bench(f'{endpoint} row encoder', lambda: serialization.query_rows_json(
+                    conn, key, query), args.repeat)
+                print(f'{"":<36} speedup x{before / after:.1f}')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
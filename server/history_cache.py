@@ -0,0 +1,107 @@
+"""Read-through cache of serialized patient test histories.
+
+GET /api/user-tests?userId= is the hottest endpoint. Its serialized JSON body
+is cached per patient in an LRU bounded by total body size. Every write path
+that touches a patient's user_tests rows invalidates that patient's entry.
+Reads take a sequence token before querying and only store their result if
+no invalidation for the patient happened in between, so a slow read can
+never put a stale history back into the cache. Only the most recent
+invalidations are remembered; a read that started before the oldest of them
+is simply not cached. The cache lives in the API
+process; run a single API process when it is enabled.
+"""
+import threading
+from collections import OrderedDict
+
+# Memory an entry costs beyond len(body): the bytes object header, the
+# OrderedDict node and the key (measured with tracemalloc on CPython 3)
+ENTRY_OVERHEAD = 176
+
+
+class HistoryCache(object):
+    """Per-patient LRU of JSON bodies bounded by memory size, including per-entry overhead"""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entry_bytes=None, enabled=True, max_invalidations=10000):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._sequence = 0
+        self.max_invalidations = max_invalidations
+        self._invalidated_at = OrderedDict()
+        # Sequence of the newest invalidation dropped from _invalidated_at
+        self._forgotten_at = -1
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """Cached body for a patient, or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            body = self._entries.get(user_id)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return body
+
+    def begin_read(self, user_id):
+        """Token to pass to put() for a read that is about to query the database"""
+        with self._lock:
+            return self._sequence
+
+    def put(self, user_id, body, token):
+        """Cache a body read with begin_read(), unless the patient was invalidated since"""
+        if not self.enabled or len(body) + ENTRY_OVERHEAD > self.max_entry_bytes:
+            return
+        with self._lock:
+            if self._forgotten_at > token or self._invalidated_at.get(user_id, -1) > token:
+                return
+            self._discard(user_id)
+            self._entries[user_id] = body
+            self._size += len(body) + ENTRY_OVERHEAD
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted) + ENTRY_OVERHEAD
+                self.evictions += 1
+
+    def invalidate(self, *user_ids):
+        """Drop the cached histories of patients whose user_tests rows changed"""
+        with self._lock:
+            self._sequence += 1
+            for user_id in user_ids:
+                self._invalidated_at[user_id] = self._sequence
+                self._invalidated_at.move_to_end(user_id)
+                if self._discard(user_id):
+                    self.invalidations += 1
+            while len(self._invalidated_at) > self.max_invalidations:
+                _, self._forgotten_at = self._invalidated_at.popitem(last=False)
+
+    def metrics(self):
+        """Hit/miss/eviction counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+    def _discard(self, user_id):
+        body = self._entries.pop(user_id, None)
+        if body is None:
+            return False
+        self._size -= len(body) + ENTRY_OVERHEAD
+        return True
@@ -0,0 +1,175 @@
+"""Idempotency-Key support for mutating requests.
+
+Completed responses are kept in a bounded in-memory LRU with a TTL. Entries
+pushed out of memory are spilled to the idempotency_keys table so a late
+retry is still answered from storage instead of repeating the write; that
+table keeps at most max_spilled rows, dropping the ones closest to expiry. While
+the first request for a key is running, duplicates wait for its result
+rather than executing the handler a second time.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Response headers that must not be replayed verbatim
+_SKIPPED_HEADERS = ('content-length', 'set-cookie', 'date')
+
+REPLAY = 'replay'
+PROCEED = 'proceed'
+MISMATCH = 'mismatch'
+IN_PROGRESS = 'in-progress'
+
+
+def scope_key(idempotency_key, *parts):
+    """Hash the client key together with the caller and route it applies to"""
+    digest = hashlib.sha256()
+    for part in parts + (idempotency_key,):
+        digest.update((part or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def fingerprint(body):
+    """Hash of the request body, used to detect a key reused for another request"""
+    return hashlib.sha256(body or b'').hexdigest()
+
+
+class StoredResponse(object):
+    __slots__ = ('fingerprint', 'status', 'headers', 'body', 'expires_at')
+
+    def __init__(self, fingerprint, status, headers, body, expires_at):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+
+class IdempotencyStore(object):
+    """Bounded, TTL-evicted response store with in-flight request coalescing"""
+
+    def __init__(self, connect, max_entries=1000, ttl_seconds=24 * 3600, wait_timeout=30, max_spilled=100000):
+        self.connect = connect
+        self.max_entries = max_entries
+        self.max_spilled = max_spilled
+        self.ttl_seconds = ttl_seconds
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def begin(self, key, request_fingerprint):
+        """Claim a key or find its stored response.
+
+        Returns (status, response): REPLAY with the stored response, PROCEED when
+        the caller now owns the key and must call complete() or abandon(),
+        MISMATCH when the key was used for a different body, or IN_PROGRESS when
+        the original request did not finish within wait_timeout.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            claimed = False
+            with self._lock:
+                stored = self._get_memory(key)
+                if stored is None:
+                    event = self._inflight.get(key)
+                    if event is None:
+                        # Claim the key first so the spill lookup can run without the lock
+                        event = self._inflight[key] = threading.Event()
+                        claimed = True
+            if claimed:
+                try:
+                    stored = self._get_spilled(key)
+                except Exception:
+                    self.abandon(key)
+                    raise
+                if stored is None:
+                    return PROCEED, None
+                self._restore(key, stored)
+            if stored is not None:
+                if stored.fingerprint != request_fingerprint:
+                    return MISMATCH, None
+                return REPLAY, stored
+            # Coalesce onto the request already running with this key
+            if not event.wait(max(0, deadline - time.monotonic())):
+                return IN_PROGRESS, None
+
+    def complete(self, key, request_fingerprint, status, headers, body):
+        """Store the response for a key claimed with begin() and wake any waiters"""
+        headers = [(name, value) for name, value in headers if name.lower() not in _SKIPPED_HEADERS]
+        stored = StoredResponse(request_fingerprint, status, headers, body, time.time() + self.ttl_seconds)
+        self._restore(key, stored)
+
+    def abandon(self, key):
+        """Release a key without storing a response, e.g. after a server error"""
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _restore(self, key, stored):
+        # Put a response in memory, release the key and spill whatever that pushed out
+        with self._lock:
+            spill = self._put_memory(key, stored)
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+        if spill:
+            self._spill(spill)
+
+    def _get_memory(self, key):
+        stored = self._entries.get(key)
+        if stored is None:
+            return None
+        if stored.expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return stored
+
+    def _put_memory(self, key, stored):
+        self._entries[key] = stored
+        self._entries.move_to_end(key)
+        evicted = []
+        now = time.time()
+        while len(self._entries) > self.max_entries:
+            old_key, old = self._entries.popitem(last=False)
+            if old.expires_at > now:
+                evicted.append((old_key, old))
+        return evicted
+
+    def _get_spilled(self, key):
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                'SELECT fingerprint, status, headers, body, expiresAt FROM idempotency_keys WHERE key = ? AND expiresAt > ?',
+                (key, time.time())
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return StoredResponse(row[0], row[1], [tuple(header) for header in json.loads(row[2])], row[3], row[4])
+
+    def _spill(self, evicted):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM idempotency_keys WHERE expiresAt <= ?', (time.time(),))
+            conn.executemany('''
+                INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, status, headers, body, expiresAt)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (key, stored.fingerprint, stored.status, json.dumps(stored.headers), stored.body, stored.expires_at)
+                for key, stored in evicted
+            ])
+            # Keep only the max_spilled rows that expire last
+            conn.execute('''
+                DELETE FROM idempotency_keys WHERE expiresAt <= (
+                    SELECT expiresAt FROM idempotency_keys ORDER BY expiresAt DESC LIMIT 1 OFFSET ?
+                )
+            ''', (self.max_spilled,))
+            conn.commit()
+        finally:
+            conn.close()
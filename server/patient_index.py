@@ -0,0 +1,352 @@
+"""In-memory fuzzy index used to spot duplicate patient records.
+
+Patients are indexed by name trigrams, a Soundex key per name token and
+their date of birth. Lookups only score the records that share at least one
+blocking key with the query, so registration-time checks and the full
+duplicate scan never fall back to comparing every pair of patients. A
+matching date of birth only counts when the last names agree, so a common
+first name plus a shared birthday is not enough to call two people the same.
+"""
+import sqlite3
+import sys
+import json
+import threading
+import unicodedata
+
+PATIENT_INDEX_QUERY = '''
+    SELECT id, userNumber, firstName, lastName, phone, dateOfBirth
+    FROM users
+    WHERE role = 'patient' AND isActive = 1
+'''
+
+# Characters that NFKD does not decompose to plain ASCII
+_TRANSLITERATE = str.maketrans({'ı': 'i', 'İ': 'i', 'ß': 'ss', 'æ': 'ae', 'ø': 'o', 'đ': 'd', 'ł': 'l'})
+
+_SOUNDEX_CODES = {}
+for _letters, _code in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'), ('l', '4'), ('mn', '5'), ('r', '6')):
+    for _letter in _letters:
+        _SOUNDEX_CODES[_letter] = _code
+
+# Score weights; they add up to 1.0
+NAME_WEIGHT = 0.6
+DOB_WEIGHT = 0.3
+PHONETIC_WEIGHT = 0.1
+
+# Last-name similarity needed before the date of birth adds to the score,
+# unless the full names are at least STRONG_NAME_SCORE similar on their own
+LAST_NAME_MIN_SCORE = 0.5
+STRONG_NAME_SCORE = 0.8
+
+# Posting of patients registered without a date of birth
+_UNDATED = ('u',)
+
+
+def normalize_name(value):
+    """Lowercase a name and strip accents and punctuation"""
+    value = (value or '').translate(_TRANSLITERATE)
+    value = unicodedata.normalize('NFKD', value)
+    chars = []
+    for char in value.lower():
+        if 'a' <= char <= 'z':
+            chars.append(char)
+        elif char.isspace() or char in "-'.":
+            chars.append(' ')
+    return ' '.join(''.join(chars).split())
+
+
+def soundex(token):
+    """Classic four character Soundex code of a single name token"""
+    if not token:
+        return ''
+    code = token[0]
+    last = _SOUNDEX_CODES.get(token[0], '')
+    for char in token[1:]:
+        digit = _SOUNDEX_CODES.get(char, '')
+        if digit and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        if char not in 'hw':
+            last = digit
+    return code.ljust(4, '0')
+
+
+def name_trigrams(first_name, last_name=''):
+    """Trigram set over both names; first/last order does not matter"""
+    grams = set()
+    for token in f'{first_name} {last_name}'.split():
+        padded = f'  {token} '
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return frozenset(grams)
+
+
+def dice(a, b):
+    """Dice coefficient of two trigram sets"""
+    total = len(a) + len(b)
+    return 2.0 * len(a & b) / total if total else 0.0
+
+
+def dob_keys(dob):
+    """Blocking keys shared by every date dob_similarity() scores above zero"""
+    keys = {('d', dob)}
+    # One key per position with that character masked out catches single typos
+    keys.update(('m', i, dob[:i] + dob[i + 1:]) for i in range(len(dob)))
+    parts = dob.split('-')
+    if len(parts) == 3:
+        keys.add(('s', parts[0], min(parts[1], parts[2]), max(parts[1], parts[2])))
+    return keys
+
+
+def dob_similarity(a, b):
+    """1.0 for the same date, 0.7 for a likely typo, 0.0 otherwise"""
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    if len(a) == len(b):
+        if sum(1 for x, y in zip(a, b) if x != y) == 1:
+            return 0.7
+        # Day and month swapped, e.g. 1990-03-04 vs 1990-04-03
+        pa, pb = a.split('-'), b.split('-')
+        if len(pa) == 3 and len(pb) == 3 and pa[0] == pb[0] and pa[1] == pb[2] and pa[2] == pb[1]:
+            return 0.7
+    return 0.0
+
+
+class _Record(object):
+    __slots__ = ('user', 'grams', 'first_grams', 'last_grams', 'phonetic', 'dob', 'dob_keys', 'keys')
+
+    def __init__(self, user):
+        first = normalize_name(user.get('firstName'))
+        last = normalize_name(user.get('lastName'))
+        self.user = user
+        self.first_grams = name_trigrams(first)
+        self.last_grams = name_trigrams(last)
+        self.grams = self.first_grams | self.last_grams
+        self.phonetic = frozenset(soundex(token) for token in f'{first} {last}'.split())
+        self.dob = (user.get('dateOfBirth') or '').strip()
+        self.dob_keys = dob_keys(self.dob) if self.dob else {_UNDATED}
+        keys = {('p', code) for code in self.phonetic}
+        keys.update(('g', gram) for gram in self.grams)
+        keys.update(self.dob_keys)
+        self.keys = keys
+
+
+class PatientIndex(object):
+    """Blocking index over active patients for fuzzy duplicate lookups"""
+
+    def __init__(self, threshold=0.6, max_posting=500):
+        self.threshold = threshold
+        # Name postings longer than this are too common to be useful on their own
+        self.max_posting = max_posting
+        self.is_built = False
+        self._lock = threading.RLock()
+        self._records = {}
+        self._postings = {}
+
+    def build(self, users):
+        """Replace the index contents with the given user rows"""
+        with self._lock:
+            self._records = {}
+            self._postings = {}
+            for user in users:
+                self._add(dict(user))
+            self.is_built = True
+
+    def add(self, user):
+        """Index a patient, replacing any previous entry with the same id"""
+        with self._lock:
+            self._remove(user['id'])
+            self._add(dict(user))
+
+    def remove(self, user_id):
+        """Drop a patient from the index"""
+        with self._lock:
+            self._remove(user_id)
+
+    def refresh(self, user):
+        """Re-index a user row after it changed; inactive or non-patient rows are dropped"""
+        user = dict(user)
+        if user.get('role', 'patient') == 'patient' and user.get('isActive', 1):
+            self.add(user)
+        else:
+            self.remove(user['id'])
+
+    def search(self, first_name, last_name, date_of_birth, limit=10, exclude_id=None):
+        """Return indexed patients likely to be the same person, best match first"""
+        query = _Record({'firstName': first_name, 'lastName': last_name, 'dateOfBirth': date_of_birth})
+        with self._lock:
+            matches = []
+            for user_id in self._candidates(query):
+                if user_id == exclude_id:
+                    continue
+                record = self._records[user_id]
+                score = self._score(query, record)
+                if score >= self.threshold:
+                    matches.append((score, user_id, record))
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        return [self._describe(record, score) for score, _, record in matches[:limit]]
+
+    def clusters(self):
+        """Group indexed patients into clusters of probable duplicates.
+
+        The scan runs on a copy of the index, so registrations and lookups are
+        not blocked while it scores. Each cluster is the lowest id patient that
+        still has unclustered matches plus those matches, so every member
+        matches the first patient of its cluster directly and weak matches
+        never chain unrelated patients together.
+        """
+        with self._lock:
+            records = dict(self._records)
+            postings = {key: set(posting) for key, posting in self._postings.items()}
+        snapshot = PatientIndex(self.threshold, self.max_posting)
+        snapshot._records = records
+        snapshot._postings = postings
+        return snapshot._scan()
+
+    def _scan(self):
+        matches = {}
+        for user_id, record in self._records.items():
+            for other_id in self._candidates(record):
+                if other_id <= user_id:
+                    continue
+                score = self._score(record, self._records[other_id])
+                if score >= self.threshold:
+                    matches.setdefault(user_id, {})[other_id] = score
+                    matches.setdefault(other_id, {})[user_id] = score
+
+        clustered = set()
+        clusters = []
+        for root_id in sorted(matches):
+            if root_id in clustered:
+                continue
+            members = sorted((other_id, score) for other_id, score in matches[root_id].items()
+                             if other_id not in clustered)
+            if not members:
+                continue
+            clustered.add(root_id)
+            clustered.update(other_id for other_id, _ in members)
+            best = max(score for _, score in members)
+            patients = [self._describe(self._records[root_id], best)]
+            patients.extend(self._describe(self._records[other_id], score) for other_id, score in members)
+            clusters.append({'patients': patients, 'size': len(patients)})
+        clusters.sort(key=lambda cluster: (-cluster['size'], cluster['patients'][0]['id']))
+        return clusters
+
+    def __len__(self):
+        return len(self._records)
+
+    def _add(self, user):
+        record = _Record(user)
+        self._records[user['id']] = record
+        for key in record.keys:
+            self._postings.setdefault(key, set()).add(user['id'])
+
+    def _remove(self, user_id):
+        record = self._records.pop(user_id, None)
+        if record is None:
+            return
+        for key in record.keys:
+            posting = self._postings.get(key)
+            if posting is not None:
+                posting.discard(user_id)
+                if not posting:
+                    del self._postings[key]
+
+    def _candidates(self, record):
+        if not record.dob:
+            return self._name_candidates(record)
+        # Two known birth dates that do not match at all rule a pair out, so
+        # dated patients only need to be compared with nearby birth dates
+        candidates = set()
+        for key in record.dob_keys:
+            candidates.update(self._postings.get(key, ()))
+        undated = self._postings.get(_UNDATED)
+        if undated:
+            if len(undated) <= self.max_posting:
+                candidates.update(undated)
+            else:
+                candidates.update(self._name_candidates(record) & undated)
+        return candidates
+
+    def _name_candidates(self, record):
+        # Without a date of birth to compare the names alone must reach this similarity
+        min_name_score = (self.threshold - PHONETIC_WEIGHT) / NAME_WEIGHT
+        # Dice >= d with |B| >= shared implies shared >= d * |A| / (2 - d)
+        min_shared = max(1, int(min_name_score * len(record.grams) / (2 - min_name_score)))
+
+        shared = {}
+        skipped = 0
+        common = []
+        for key in record.keys:
+            posting = self._postings.get(key)
+            if not posting or key[0] not in 'gp':
+                continue
+            if len(posting) > self.max_posting:
+                if key[0] == 'p':
+                    common.append(posting)
+                else:
+                    skipped += 1
+            elif key[0] == 'g':
+                for user_id in posting:
+                    shared[user_id] = shared.get(user_id, 0) + 1
+        # Trigrams too common to count may be shared with any candidate
+        min_shared = max(1, min_shared - skipped)
+        candidates = {user_id for user_id, count in shared.items() if count >= min_shared}
+        # Very common names only block together: first name AND last name sound alike
+        if len(common) >= 2:
+            common.sort(key=len)
+            candidates.update(common[0] & common[1])
+        return candidates
+
+    def _score(self, a, b):
+        name_score = dice(a.grams, b.grams)
+        phonetic_score = 1.0 if a.phonetic and a.phonetic == b.phonetic else 0.0
+        score = NAME_WEIGHT * name_score + PHONETIC_WEIGHT * phonetic_score
+        dob_score = dob_similarity(a.dob, b.dob)
+        if a.dob and b.dob and not dob_score:
+            # Two different people can share even a rare name; a different birth date says so
+            return score - DOB_WEIGHT
+        if name_score >= STRONG_NAME_SCORE or self._last_names_agree(a, b):
+            score += DOB_WEIGHT * dob_score
+        return score
+
+    @staticmethod
+    def _last_names_agree(a, b):
+        if dice(a.last_grams, b.last_grams) >= LAST_NAME_MIN_SCORE:
+            return True
+        # First and last name entered the other way round
+        return (dice(a.first_grams, b.last_grams) >= LAST_NAME_MIN_SCORE
+                and dice(a.last_grams, b.first_grams) >= LAST_NAME_MIN_SCORE)
+
+    @staticmethod
+    def _describe(record, score):
+        user = record.user
+        return {
+            'id': user['id'],
+            'userNumber': user.get('userNumber'),
+            'firstName': user.get('firstName'),
+            'lastName': user.get('lastName'),
+            'phone': user.get('phone'),
+            'dateOfBirth': user.get('dateOfBirth'),
+            'score': round(score, 3)
+        }
+
+
+def build_from_connection(conn, index=None):
+    """Build (or rebuild) an index from the users table"""
+    if index is None:
+        index = PatientIndex()
+    cursor = conn.execute(PATIENT_INDEX_QUERY)
+    columns = [column[0] for column in cursor.description]
+    index.build(dict(zip(columns, row)) for row in cursor)
+    return index
+
+
+if __name__ == '__main__':
+    # Batch duplicate scan: python patient_index.py [database.sqlite]
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'database.sqlite')
+    index = build_from_connection(conn)
+    conn.close()
+    print(json.dumps({'patients': len(index), 'clusters': index.clusters()}, indent=2, ensure_ascii=False))
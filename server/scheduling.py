@@ -0,0 +1,199 @@
+"""Interval index over personnel availability windows and booked slots.
+
+Each personnel member publishes availability windows for a date (for example
+08:00-12:00 in 15 minute slots, two patients per slot). Windows for one
+personnel/date are kept sorted by start time so the window containing a
+requested time is found with a binary search, and booked counts are kept per
+slot, so availability and conflict checks never scan existing appointments.
+"""
+import bisect
+import threading
+from datetime import datetime
+
+# Appointments in these states no longer hold their slot
+RELEASED_STATUSES = ('cancelled',)
+
+
+class SchedulingError(ValueError):
+    """Raised when a window or booking conflicts with the schedule"""
+
+
+def parse_date(value):
+    """Validate a YYYY-MM-DD date and return it unchanged"""
+    datetime.strptime(value, '%Y-%m-%d')
+    return value
+
+
+def to_minutes(value):
+    """Convert HH:MM to minutes after midnight"""
+    parsed = datetime.strptime(value, '%H:%M')
+    return parsed.hour * 60 + parsed.minute
+
+
+def to_time(minutes):
+    """Convert minutes after midnight to HH:MM"""
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+class _Window(object):
+    __slots__ = ('id', 'start', 'end', 'slot_minutes', 'capacity')
+
+    def __init__(self, window_id, start, end, slot_minutes, capacity):
+        self.id = window_id
+        self.start = start
+        self.end = end
+        self.slot_minutes = slot_minutes
+        self.capacity = capacity
+
+    def slot_starts(self):
+        return range(self.start, self.end - self.slot_minutes + 1, self.slot_minutes)
+
+
+class SlotIndex(object):
+    """Availability windows and booked counts keyed by (personnelId, date)"""
+
+    def __init__(self):
+        self.is_loaded = False
+        self._lock = threading.RLock()
+        self._windows = {}
+        self._starts = {}
+        self._booked = {}
+        self._personnel_by_date = {}
+
+    def load(self, windows, bookings):
+        """Replace the index with availability rows and active appointment rows"""
+        with self._lock:
+            self._windows = {}
+            self._starts = {}
+            self._booked = {}
+            self._personnel_by_date = {}
+            for row in windows:
+                self._insert_window(
+                    row['personnelId'], row['date'], row['id'], to_minutes(row['startTime']),
+                    to_minutes(row['endTime']), row['slotMinutes'], row['capacity']
+                )
+            for row in bookings:
+                key = (row['personnelId'], row['scheduledDate'])
+                minute = to_minutes(row['scheduledTime'])
+                booked = self._booked.setdefault(key, {})
+                booked[minute] = booked.get(minute, 0) + 1
+            self.is_loaded = True
+
+    def check_window(self, personnel_id, date, start_time, end_time, slot_minutes):
+        """Validate a new window; raises SchedulingError if it overlaps an existing one"""
+        start, end = to_minutes(start_time), to_minutes(end_time)
+        if end <= start:
+            raise SchedulingError('endTime must be after startTime')
+        if slot_minutes <= 0 or (end - start) < slot_minutes:
+            raise SchedulingError('Window is shorter than one slot')
+        with self._lock:
+            windows = self._windows.get((personnel_id, date), [])
+            starts = self._starts.get((personnel_id, date), [])
+            pos = bisect.bisect_left(starts, start)
+            if pos > 0 and windows[pos - 1].end > start:
+                raise SchedulingError('Window overlaps an existing availability window')
+            if pos < len(windows) and windows[pos].start < end:
+                raise SchedulingError('Window overlaps an existing availability window')
+        return start, end
+
+    def add_window(self, personnel_id, date, start_time, end_time, slot_minutes, capacity, store):
+        """Check and index a new window.
+
+        store() writes the window to the database and returns its id. While it
+        runs, the window is held in the index with no capacity, so overlapping
+        windows are rejected without keeping the index locked during the write.
+        """
+        with self._lock:
+            start, end = self.check_window(personnel_id, date, start_time, end_time, slot_minutes)
+            window = self._insert_window(personnel_id, date, None, start, end, slot_minutes, 0)
+        try:
+            window_id = store()
+        except Exception:
+            with self._lock:
+                self._remove_window(personnel_id, date, window)
+            raise
+        with self._lock:
+            window.id = window_id
+            window.capacity = capacity
+        return window_id
+
+    def free_slots(self, date, personnel_id=None):
+        """List slots with remaining capacity on a date, ordered by time then personnel"""
+        with self._lock:
+            if personnel_id is not None:
+                personnel_ids = [personnel_id] if (personnel_id, date) in self._windows else []
+            else:
+                personnel_ids = sorted(self._personnel_by_date.get(date, ()))
+            slots = []
+            for pid in personnel_ids:
+                booked = self._booked.get((pid, date), {})
+                for window in self._windows[(pid, date)]:
+                    for minute in window.slot_starts():
+                        remaining = window.capacity - booked.get(minute, 0)
+                        if remaining > 0:
+                            slots.append((minute, pid, remaining))
+        slots.sort()
+        return [
+            {'personnelId': pid, 'date': date, 'time': to_time(minute), 'remaining': remaining}
+            for minute, pid, remaining in slots
+        ]
+
+    def reserve(self, personnel_id, date, time):
+        """Claim one place in a slot; returns the slot capacity or raises SchedulingError"""
+        minute = to_minutes(time)
+        with self._lock:
+            window = self._find_window(personnel_id, date, minute)
+            if window is None:
+                raise SchedulingError('Requested time is not an available slot')
+            booked = self._booked.setdefault((personnel_id, date), {})
+            if booked.get(minute, 0) >= window.capacity:
+                raise SchedulingError('Slot is fully booked')
+            booked[minute] = booked.get(minute, 0) + 1
+            return window.capacity
+
+    def release(self, personnel_id, date, time):
+        """Give back a place claimed by reserve() or held by a cancelled appointment"""
+        minute = to_minutes(time)
+        with self._lock:
+            booked = self._booked.get((personnel_id, date))
+            if booked and booked.get(minute, 0) > 0:
+                booked[minute] -= 1
+                if not booked[minute]:
+                    del booked[minute]
+
+    def _find_window(self, personnel_id, date, minute):
+        starts = self._starts.get((personnel_id, date))
+        if not starts:
+            return None
+        pos = bisect.bisect_right(starts, minute) - 1
+        if pos < 0:
+            return None
+        window = self._windows[(personnel_id, date)][pos]
+        if minute + window.slot_minutes > window.end:
+            return None
+        if (minute - window.start) % window.slot_minutes:
+            return None
+        return window
+
+    def _insert_window(self, personnel_id, date, window_id, start, end, slot_minutes, capacity):
+        key = (personnel_id, date)
+        starts = self._starts.setdefault(key, [])
+        pos = bisect.bisect_left(starts, start)
+        starts.insert(pos, start)
+        window = _Window(window_id, start, end, slot_minutes, capacity)
+        self._windows.setdefault(key, []).insert(pos, window)
+        self._personnel_by_date.setdefault(date, set()).add(personnel_id)
+        return window
+
+    def _remove_window(self, personnel_id, date, window):
+        key = (personnel_id, date)
+        windows = self._windows[key]
+        pos = windows.index(window)
+        del windows[pos]
+        del self._starts[key][pos]
+        if not windows:
+            del self._windows[key]
+            del self._starts[key]
+            self._personnel_by_date[date].discard(personnel_id)
+            if not self._personnel_by_date[date]:
+                del self._personnel_by_date[date]
@@ -0,0 +1,152 @@
+"""Fast JSON serialization for query results.
+
+List endpoints used to turn every sqlite3.Row into a dict and hand the list
+to jsonify. Here each distinct column list gets a generated row encoder that
+works on plain tuple rows. With orjson installed the encoder builds a dict
+literal for orjson to serialize; without it the encoder concatenates
+precomputed key fragments with the encoded values, so keys are encoded once
+per query shape rather than once per row. Columns that already hold JSON
+text (users.address) are embedded as-is instead of being parsed and
+re-encoded on every read.
+"""
+import gzip
+import json
+import math
+import threading
+import zlib
+from json.encoder import encode_basestring
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional, faster JSON backend
+    orjson = None
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; install with app.json = ORJSONProvider(app)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def encode_value(value):
+    """JSON text of a single SQLite value"""
+    kind = type(value)
+    if kind is str:
+        return encode_basestring(value)
+    if value is None:
+        return 'null'
+    if kind is int:
+        return int.__repr__(value)
+    if kind is float:
+        return float.__repr__(value) if math.isfinite(value) else 'null'
+    if kind is bytes:
+        return encode_basestring(value.decode('utf-8', 'replace'))
+    return json.dumps(value, ensure_ascii=False)
+
+
+def embed_json(value):
+    """Column value holding JSON text, in the form the orjson encoder embeds"""
+    if not value:
+        return None
+    if hasattr(orjson, 'Fragment'):
+        return orjson.Fragment(value)
+    return orjson.loads(value)
+
+
+def _compile_dict(columns, json_columns):
+    # Row -> dict literal; orjson then encodes the whole list natively
+    names = [f'v{i}' for i in range(len(columns))]
+    items = []
+    for name, column in zip(names, columns):
+        value = f'_embed({name})' if column in json_columns else name
+        items.append(f'{column!r}: {value}')
+    unpack = f"    {', '.join(names)}, = row\n" if names else ''
+    return f"def encode_row(row):\n{unpack}    return {{{', '.join(items)}}}\n"
+
+
+def _compile_text(columns, json_columns):
+    # Row -> JSON text; strings and NULLs are inlined since they make up most cells
+    names = [f'v{i}' for i in range(len(columns))]
+    parts = []
+    for i, (name, column) in enumerate(zip(names, columns)):
+        prefix = ('{' if i == 0 else ',') + encode_basestring(column) + ':'
+        if column in json_columns:
+            value = f"({name} or 'null')"
+        else:
+            value = f"(_str({name}) if {name}.__class__ is str else 'null' if {name} is None else _value({name}))"
+        parts.append(f'{prefix!r} + {value}')
+    if not parts:
+        return "def encode_row(row):\n    return '{}'\n"
+    return f"def encode_row(row):\n    {', '.join(names)}, = row\n    return {' + '.join(parts)} + '}}'\n"
+
+
+def row_encoder(columns, json_columns=()):
+    """Get the cached encoder for tuple rows with these columns.
+
+    The encoder returns a dict when orjson is installed and JSON text otherwise.
+    """
+    key = (tuple(columns), tuple(json_columns))
+    encoder = _encoders.get(key)
+    if encoder is None:
+        with _encoders_lock:
+            encoder = _encoders.get(key)
+            if encoder is None:
+                compile_source = _compile_text if orjson is None else _compile_dict
+                namespace = {'_value': encode_value, '_str': encode_basestring, '_embed': embed_json}
+                exec(compile_source(*key), namespace)
+                encoder = _encoders[key] = namespace['encode_row']
+    return encoder
+
+
+def _execute(conn, query, params):
+    cursor = conn.cursor()
+    # Plain tuples are cheaper than sqlite3.Row and all the encoder needs
+    cursor.row_factory = None
+    cursor.execute(query, params)
+    return cursor
+
+
+def query_rows_json(conn, key, query, params=(), json_columns=()):
+    """Run a query and return {"<key>": [rows...]} as JSON bytes"""
+    cursor = _execute(conn, query, params)
+    encode_row = row_encoder([column[0] for column in cursor.description], json_columns)
+    if orjson is not None:
+        return orjson.dumps({key: list(map(encode_row, cursor))})
+    rows = ','.join(map(encode_row, cursor))
+    return f'{{{encode_basestring(key)}:[{rows}]}}'.encode('utf-8')
+
+
+def query_row_json(conn, key, query, params=(), json_columns=()):
+    """Run a query and return {"<key>": row} as JSON bytes, or None when no row matches"""
+    cursor = _execute(conn, query, params)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    encode_row = row_encoder([column[0] for column in cursor.description], json_columns)
+    if orjson is not None:
+        return orjson.dumps({key: encode_row(row)})
+    return f'{{{encode_basestring(key)}:{encode_row(row)}}}'.encode('utf-8')
+
+
+def choose_encoding(accept_encodings):
+    """Pick gzip or deflate from a werkzeug Accept-Encoding header, or None"""
+    for encoding in ('gzip', 'deflate'):
+        if accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=6):
+    """Compress a response body for the given Content-Encoding"""
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zlib.compress(data, level)
@@ -0,0 +1,154 @@
+"""Numeric result series for per-patient trend charts.
+
+testResult is free text ("5.6 %", "32 ng/mL", "<0.5"). Whenever a result is
+stored, the number it starts with is parsed once and written to result_series,
+indexed by (userId, testCatalogId, testDate). Trend requests then read a
+patient's series straight from that index, downsample it for charting and
+compute summary statistics per test with array operations instead of
+parsing the whole history on every request.
+"""
+import math
+import re
+from array import array
+
+# A result has to start with its value, and dates ("2024-05-01") or ratios
+# ("1:160") are not values. "<0.5" and ">1000" are censored and are not
+# charted as exact values. A comma before exactly three digits groups
+# thousands ("1,234"), any other comma is a decimal separator ("31,5").
+_NUMBER = re.compile(
+    r'\s*(?P<censored>[<>]=?|[≤≥])?\s*'
+    r'(?:(?P<grouped>[-+]?\d{1,3}(?:,\d{3})+(?![,\d])(?:\.\d+)?)|(?P<plain>[-+]?\d+(?:[.,]\d+)?))'
+    r'(?![\d.,:/-])'
+)
+
+SERIES_SOURCE_QUERY = '''
+    SELECT id, userId, testCatalogId, testResult, COALESCE(testDate, date(createdAt)) AS testDate
+    FROM user_tests
+'''
+
+
+def parse_numeric_result(text):
+    """Numeric value a result string starts with, or None if it has none or is censored"""
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return float(text) if math.isfinite(text) else None
+    match = _NUMBER.match(str(text))
+    if not match or match.group('censored'):
+        return None
+    if match.group('grouped'):
+        return float(match.group('grouped').replace(',', ''))
+    return float(match.group('plain').replace(',', '.'))
+
+
+def _store(conn, rows):
+    stored = []
+    cleared = []
+    for user_test_id, user_id, test_catalog_id, result, test_date in rows:
+        value = parse_numeric_result(result)
+        if value is None or not test_date:
+            cleared.append((user_test_id,))
+        else:
+            stored.append((user_test_id, user_id, test_catalog_id, test_date, value))
+    if cleared:
+        conn.executemany('DELETE FROM result_series WHERE userTestId = ?', cleared)
+    if stored:
+        conn.executemany('''
+            INSERT OR REPLACE INTO result_series (userTestId, userId, testCatalogId, testDate, value)
+            VALUES (?, ?, ?, ?, ?)
+        ''', stored)
+
+
+def record_results(conn, user_test_ids):
+    """Refresh the series points of the given user tests; call inside the writing transaction"""
+    user_test_ids = list(user_test_ids)
+    for start in range(0, len(user_test_ids), 500):
+        chunk = user_test_ids[start:start + 500]
+        placeholders = ', '.join('?' * len(chunk))
+        rows = conn.execute(f'{SERIES_SOURCE_QUERY} WHERE id IN ({placeholders})', chunk).fetchall()
+        _store(conn, [tuple(row) for row in rows])
+
+
+def remove_results(conn, user_test_ids):
+    """Drop the series points of deleted user tests"""
+    conn.executemany('DELETE FROM result_series WHERE userTestId = ?', [(i,) for i in user_test_ids])
+
+
+def backfill(conn):
+    """Add series points for stored results that predate the result_series table"""
+    rows = conn.execute(f'''
+        {SERIES_SOURCE_QUERY}
+        WHERE testResult IS NOT NULL AND id NOT IN (SELECT userTestId FROM result_series)
+    ''').fetchall()
+    _store(conn, [tuple(row) for row in rows])
+
+
+def downsample(values, max_points):
+    """Largest-Triangle-Three-Buckets downsampling; keeps peaks and the first/last point"""
+    count = len(values)
+    if max_points >= count or max_points < 3:
+        return list(range(count))
+
+    keep = [0]
+    bucket_size = (count - 2) / (max_points - 2)
+    previous = 0
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        # Average of the next bucket is the third vertex of the triangle
+        avg_x = (end + next_end - 1) / 2.0
+        avg_y = math.fsum(values[end:next_end]) / max(1, next_end - end)
+        prev_y = values[previous]
+        best, best_area = start, -1.0
+        for i in range(start, end):
+            area = abs((previous - avg_x) * (values[i] - prev_y) - (previous - i) * (avg_y - prev_y))
+            if area > best_area:
+                best, best_area = i, area
+        keep.append(best)
+        previous = best
+    keep.append(count - 1)
+    return keep
+
+
+def summarize(dates, values):
+    """Summary statistics of one series held in an array('d')"""
+    count = len(values)
+    last = values[-1]
+    previous = values[-2] if count > 1 else None
+    return {
+        'count': count,
+        'min': min(values),
+        'max': max(values),
+        'mean': round(math.fsum(values) / count, 4),
+        'last': last,
+        'previous': previous,
+        'delta': round(last - previous, 4) if previous is not None else None,
+        'firstDate': dates[0],
+        'lastDate': dates[-1]
+    }
+
+
+def build_trends(rows, max_points):
+    """Group (testCatalogId, testName, normalRange, testDate, value) rows ordered by test and date into trends"""
+    trends = []
+    current = None
+    for test_catalog_id, test_name, normal_range, test_date, value in rows:
+        if current is None or current['testCatalogId'] != test_catalog_id:
+            current = {
+                'testCatalogId': test_catalog_id,
+                'testName': test_name,
+                'normalRange': normal_range,
+                'dates': [],
+                'values': array('d')
+            }
+            trends.append(current)
+        current['dates'].append(test_date)
+        current['values'].append(value)
+
+    for trend in trends:
+        dates = trend.pop('dates')
+        values = trend.pop('values')
+        trend['summary'] = summarize(dates, values)
+        trend['points'] = [{'date': dates[i], 'value': values[i]} for i in downsample(values, max_points)]
+    return trends